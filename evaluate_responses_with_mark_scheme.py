@@ -12,9 +12,12 @@ import sys
 import time
 import traceback
 import re
+import orjson
 import pandas as pd
 import requests
 
+import retry_backoff
+
 SUPPORTED_MODELS = {'gpt-3.5-turbo', 'gpt-4', 'gpt-4o', 'insolvency_bot_with_gpt-3.5-turbo', 'insolvency_bot_with_gpt-4', 'insolvency_bot_with_gpt-4o'}
 SUPPORTED_MODELS_CONCAT = '|'.join(SUPPORTED_MODELS)
 COMMAND_LINE_PARAM = f"Usage: python evaluate_bot_responses_with_mark_scheme.py {SUPPORTED_MODELS_CONCAT} train|test"
@@ -46,8 +49,13 @@ headers = {
     'Authorization': 'Bearer ' + os.environ["OPENAI_API_KEY"],
 }
 
+# Reuse one connection for all the calls to the API rather than opening a new one per criterion.
+session = requests.Session()
+session.headers.update(headers)
+
 column_to_evaluate = 'bot_response'
 
+re_whitespace = re.compile(r'\s+')
 re_yes = re.compile(r'(?i)\b(?:yes|definitely|certainly)\b')
 re_maybe = re.compile(r'(?i)\b(?:maybe|however|but|correct)\b')
 re_mention_insolvency_act = re.compile(r'(?i)\b(?:ia|insolvency act|1986)\b')
@@ -76,7 +84,7 @@ for idx in range(len(df)):
         scores_this_q = []
         for j in range(len(rows)):
             criterion = criteria[j]
-            criterion = re.sub(r'\s+', ' ', criterion)
+            criterion = re_whitespace.sub(' ', criterion)
             print("\nCRITERION: ", criterion)
 
             if pd.isna(answer) or answer is None:
@@ -92,27 +100,34 @@ for idx in range(len(df)):
                 ],
                 "max_tokens":10
             }
-            for attempt in range(3):
+            r = None
+            for attempt in range(retry_backoff.MAX_ATTEMPTS):
                 print("attempt", attempt)
+                response = None
                 try:
-                    response = requests.post('https://api.openai.com/v1/chat/completions', headers=headers,
-                                             json=json_data)
+                    response = session.post('https://api.openai.com/v1/chat/completions', data=orjson.dumps(json_data))
                     time.sleep(18)  # avoid rate limiting by OpenAI
                     if response.status_code != 200:
                         print ("\tResponse status code =", response.status_code)
-                        if attempt < 2:
+                        if not retry_backoff.is_retryable(response):
+                            break
+                        if attempt < retry_backoff.MAX_ATTEMPTS - 1:
                             print("\tTry again")
-                        time.sleep(10)
+                            time.sleep(retry_backoff.get_delay(attempt, response))
                         continue
-                    r = response.json()["choices"][0]["message"]["content"]
-                    r = re.sub(r'\s+', ' ', r)
+                    r = orjson.loads(response.content)["choices"][0]["message"]["content"]
+                    r = re_whitespace.sub(' ', r)
                     break
                 except:
                     print ("\tException encountered when calling OpenAI API.")
-                    if attempt < 2:
-                        print("\tTry again")
                     traceback.print_exc()
-                    time.sleep(10)
+                    if attempt < retry_backoff.MAX_ATTEMPTS - 1:
+                        print("\tTry again")
+                        time.sleep(retry_backoff.get_delay(attempt, response))
+
+            if r is None:
+                print(f"\tNo assessment received from OpenAI API after {attempt + 1} attempts. Treating it as a \"no\".")
+                r = ""
 
             print(column_to_evaluate, idx, question_no, r)
             mark_scheme_assessments[idx] += r + "|"
@@ -0,0 +1,182 @@
+'''
+Run all train or test questions through GPT-3-5 Turbo, GPT-4 or GPT-4o using the OpenAI Batch API
+
+Usage: python generate_responses_batch.py gpt-3.5-turbo|gpt-4|gpt-4o train|test [batch_id]
+
+The Batch API costs half as much as calling the model directly and has a separate rate limit, but can take up to
+24 hours to return. The output file is the same as for generate_responses_gpt.py, so it can be evaluated in the same
+way, except that bot_response_time is left empty for questions answered by the batch, as the Batch API does not report
+how long each question took.
+
+Responses are stored in the same .llm_cache as generate_responses_gpt.py, and only questions which are not already
+cached are submitted. If the script stops while waiting for a batch, pass the batch id it printed to pick up the same
+batch instead of submitting a new one.
+
+You need to set environment variable OPENAI_API_KEY first.
+'''
+
+import json
+import os
+import re
+import sys
+import time
+import traceback
+
+import pandas as pd
+import requests
+
+import response_cache
+import retry_backoff
+
+SUPPORTED_MODELS = {'gpt-3.5-turbo', 'gpt-4', 'gpt-4o'}
+SUPPORTED_MODELS_CONCAT = '|'.join(SUPPORTED_MODELS)
+COMMAND_LINE_PARAM = f"Usage: python generate_responses_batch.py {SUPPORTED_MODELS_CONCAT} train|test [batch_id]"
+POLL_INTERVAL_SECONDS = 60
+FINISHED_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+re_whitespace = re.compile(r'\s+')
+
+if len(sys.argv) not in (3, 4):
+    print(COMMAND_LINE_PARAM)
+    exit()
+
+if os.environ.get("OPENAI_API_KEY") == "" or os.environ.get("OPENAI_API_KEY") is None:
+    print("Please set environment variable OPENAI_API_KEY first.")
+    exit()
+
+MODEL = sys.argv[1]
+if MODEL not in SUPPORTED_MODELS:
+    print(COMMAND_LINE_PARAM)
+    print("Please set model to one of ", " or ".join(SUPPORTED_MODELS))
+    exit()
+TRAIN_TEST = sys.argv[2]
+BATCH_ID = sys.argv[3] if len(sys.argv) == 4 else None
+
+print(f"Dataset: {TRAIN_TEST}")
+
+df = pd.read_csv(f"{TRAIN_TEST}_questions.csv", encoding="utf-8", sep="\t")
+
+session = requests.Session()
+session.headers.update({'Authorization': 'Bearer ' + os.environ["OPENAI_API_KEY"]})
+
+
+def get_with_retries(url):
+    '''
+    GET from the OpenAI API, retrying transient failures so that one error while polling does not lose the batch.
+    '''
+    for attempt in range(retry_backoff.MAX_ATTEMPTS):
+        response = None
+        try:
+            response = session.get(url)
+            response.raise_for_status()
+            return response
+        except requests.RequestException:
+            traceback.print_exc()
+            if not retry_backoff.is_retryable(response) or attempt == retry_backoff.MAX_ATTEMPTS - 1:
+                print(f"Giving up. Run the script again with batch id {batch_id} to pick up where it left off.")
+                raise
+            print("\tTry again")
+            time.sleep(retry_backoff.get_delay(attempt, response))
+
+
+def download_results(file_id):
+    response = get_with_retries(f"https://api.openai.com/v1/files/{file_id}/content")
+    return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+
+def submit_batch(questions):
+    # One chat completion request per question, identified by its question number.
+    batch_input = ""
+    for question in questions.itertuples(index=False):
+        batch_input += json.dumps({
+            "custom_id": question.question_no,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                'model': MODEL,
+                'messages': [
+                    {"role": "user", "content": question.question_text},
+                ],
+            },
+        }) + "\n"
+
+    response = session.post('https://api.openai.com/v1/files', data={"purpose": "batch"},
+                            files={"file": (f"batch_input_{TRAIN_TEST}_{MODEL}.jsonl", batch_input.encode("utf-8"))})
+    response.raise_for_status()
+    input_file_id = response.json()["id"]
+
+    response = session.post('https://api.openai.com/v1/batches', json={
+        "input_file_id": input_file_id,
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h",
+    })
+    response.raise_for_status()
+    return response.json()
+
+
+# The Batch API has no way of reporting cache hits, so only submit the questions which have not been answered before.
+question_no_to_result = {}
+for question in df.itertuples(index=False):
+    result = response_cache.get(MODEL, question.question_text)
+    if result is not None:
+        question_no_to_result[question.question_no] = result
+uncached = df[~df.question_no.isin(question_no_to_result)]
+print(f"Response cache: {len(question_no_to_result)} hits, {len(uncached)} misses")
+
+batch_id = BATCH_ID
+if batch_id is None and len(uncached) > 0:
+    batch = submit_batch(uncached)
+    batch_id = batch["id"]
+    print(f"Submitted batch {batch_id} with {len(uncached)} questions")
+
+if batch_id is not None:
+    batch = get_with_retries(f"https://api.openai.com/v1/batches/{batch_id}").json()
+    while batch["status"] not in FINISHED_BATCH_STATUSES:
+        time.sleep(POLL_INTERVAL_SECONDS)
+        batch = get_with_retries(f"https://api.openai.com/v1/batches/{batch_id}").json()
+        print(f"\tBatch status: {batch['status']} {batch.get('request_counts')}")
+
+    if batch["status"] != "completed":
+        print(f"Batch {batch_id} finished with status {batch['status']}: {batch.get('errors')}")
+
+    # Requests that succeeded are written to the output file, and those that failed to the error file. Either is left
+    # unset if it would be empty, e.g. there is no output file when every request failed.
+    results = []
+    if batch.get("output_file_id"):
+        results += download_results(batch["output_file_id"])
+    if batch.get("error_file_id"):
+        results += download_results(batch["error_file_id"])
+
+    question_no_to_text = dict(zip(df.question_no, df.question_text))
+    for result in results:
+        if result.get("error") or result["response"]["status_code"] != 200:
+            print(f"\tNo response for {result['custom_id']}: {result.get('error') or result['response']['body']}")
+            continue
+        q_no = result["custom_id"]
+        question_no_to_result[q_no] = {"response": result["response"]["body"]["choices"][0]["message"]["content"],
+                                       "time": None, "attempts": 1}
+        if q_no in question_no_to_text:
+            response_cache.put(MODEL, question_no_to_text[q_no], question_no_to_result[q_no])
+
+bot_responses = [""] * len(df)
+bot_times = [None] * len(df)
+# Left empty for unanswered questions, as the Batch API makes one attempt per request and does not retry it.
+bot_attempts = [None] * len(df)
+for idx, q_no in enumerate(df.question_no):
+    if q_no in question_no_to_result:
+        bot_responses[idx] = re_whitespace.sub(' ', question_no_to_result[q_no]["response"])
+        bot_times[idx] = question_no_to_result[q_no]["time"]
+        bot_attempts[idx] = question_no_to_result[q_no]["attempts"]
+
+print(f"Received {len(question_no_to_result)} of {len(df)} responses")
+
+df["bot_response"] = bot_responses
+df["bot_response_time"] = bot_times
+df["bot_response_attempts"] = pd.array(bot_attempts, dtype="Int64")
+
+df.to_csv(f"output_{TRAIN_TEST}_{MODEL}.csv", sep="\t", encoding="utf-8", index=False)
+
+# As in generate_responses_gpt.py, fail the run if any question is unanswered. Running the script again only submits
+# those questions, as the rest are cached.
+if len(question_no_to_result) < len(df):
+    sys.exit(1)
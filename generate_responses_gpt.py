@@ -4,20 +4,35 @@ Run all train or test questions through GPT-3-5 Turbo or GPT-4
 Usage: python generate_responses_gpt.py gpt-3.5-turbo|gpt-4 train|test
 
 You need to set environment variable OPENAI_API_KEY first.
+
+Responses are cached in .llm_cache, so a re-run only asks questions which have changed. Delete that folder to ask them all again.
 '''
 
 import os
 import re
 import sys
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+import response_cache
+import retry_backoff
 
 SUPPORTED_MODELS = {'gpt-3.5-turbo', 'gpt-4', 'gpt-4o'}
 SUPPORTED_MODELS_CONCAT = '|'.join(SUPPORTED_MODELS)
 COMMAND_LINE_PARAM = f"Usage: python generate_responses_gpt.py {SUPPORTED_MODELS_CONCAT} train|test"
+MAX_WORKERS = 8  # Number of questions sent to the API concurrently. Keep within the account's rate limit.
+
+re_whitespace = re.compile(r'\s+')
+
+# Written to the output when every attempt fails. The script then exits with an error, see the end of the file.
+EMPTY_RESULT = {"response": "", "time": None, "attempts": retry_backoff.MAX_ATTEMPTS}
 
 if len(sys.argv) != 3:
     print(COMMAND_LINE_PARAM)
@@ -43,15 +58,27 @@ headers = {
     'Authorization': 'Bearer ' + os.environ["OPENAI_API_KEY"],
 }
 
-bot_responses = [""] * len(df)
-bot_times = [0] * len(df)
-bot_attempts = [0] * len(df)
-for idx in range(len(df)):
-    q = df.question_text.iloc[idx]
-    q_no = df.question_no.iloc[idx]
-    print(f"Asking question: {q_no}: {q}")
+# Share one connection pool between the worker threads, so each API call reuses an open TLS connection.
+session = requests.Session()
+session.headers.update(headers)
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+
+OUTPUT_FILE = f"output_{TRAIN_TEST}_{MODEL}.csv"
+OUTPUT_COLUMNS = list(df.columns) + ["bot_response", "bot_response_time", "bot_response_attempts"]
+
+# Each row is appended to the output file as soon as it is answered, so a crash part way through keeps what was done.
+output_lock = threading.Lock()
+pd.DataFrame(columns=OUTPUT_COLUMNS).to_csv(OUTPUT_FILE, sep="\t", encoding="utf-8", index=False)
+
+
+def write_row(row):
+    with output_lock:
+        pd.DataFrame([row], columns=OUTPUT_COLUMNS).to_csv(OUTPUT_FILE, mode="a", header=False, sep="\t",
+                                                          encoding="utf-8", index=False)
+
 
-    starttime = time.time()
+def ask_gpt(q, q_no):
+    starttime = time.perf_counter()
 
     json_data = {
         'model': MODEL,
@@ -59,26 +86,68 @@ for idx in range(len(df)):
             {"role": "user", "content": q},
         ],
     }
-    for attempt in range(3):
-        print("attempt calling GPT API:", attempt)
+    for attempt in range(retry_backoff.MAX_ATTEMPTS):
+        print(f"{q_no}: attempt calling GPT API:", attempt)
+        response = None
         try:
-            response = requests.post('https://api.openai.com/v1/chat/completions', headers=headers, json=json_data)
-            r = response.json()["choices"][0]["message"]["content"]
+            response = session.post('https://api.openai.com/v1/chat/completions', data=orjson.dumps(json_data))
+            r = orjson.loads(response.content)["choices"][0]["message"]["content"]
             break
         except:
-            print("Try again")
             traceback.print_exc()
-            time.sleep(10)
-    bot_responses[idx] = re.sub(r'\s+', ' ', r)
+            if not retry_backoff.is_retryable(response):
+                print(f"{q_no}: Not retrying after response status code {response.status_code}")
+                return None
+            if attempt < retry_backoff.MAX_ATTEMPTS - 1:
+                print(f"{q_no}: Try again")
+                time.sleep(retry_backoff.get_delay(attempt, response))
+    else:
+        # Return nothing, so that the failure is not cached and the question is asked again on the next run.
+        return None
+
+    endtime = time.perf_counter()
+
+    return {"response": r, "time": endtime - starttime, "attempts": attempt + 1}
+
+
+def process_question(question):
+    q = question.question_text
+    q_no = question.question_no
+    print(f"Asking question: {q_no}: {q}")
+
+    result = response_cache.get_or_compute(MODEL, q, lambda: ask_gpt(q, q_no))
+    answered = result is not None
+    if not answered:
+        print(f"\tNo response to {q_no}")
+        result = EMPTY_RESULT
+    r = result["response"]
+
+    row = question._asdict()
+    row["bot_response"] = re_whitespace.sub(' ', r)
+    row["bot_response_time"] = result["time"]
+    row["bot_response_attempts"] = result["attempts"]
+    write_row(row)
+
+    print(f"\tReceived response to {q_no}: ", r)
+
+    return answered
+
 
-    endtime = time.time()
-    bot_times[idx] = endtime - starttime
-    bot_attempts[idx] = attempt + 1
+# The questions are independent and the time is spent waiting on the API, so send several at once.
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    answered = list(executor.map(process_question, df.itertuples(index=False)))
 
-    print("\tReceived response: ", r)
+print(f"Response cache: {response_cache.hits} hits, {response_cache.misses} misses")
+num_failed = answered.count(False)
+print(f"Questions with no response: {num_failed}")
 
-df["bot_response"] = bot_responses
-df["bot_response_time"] = bot_times
-df["bot_response_attempts"] = bot_attempts
+# Rows were appended in the order they finished, so put them back in question order.
+question_order = {q_no: i for i, q_no in enumerate(df.question_no)}
+df_output = pd.read_csv(OUTPUT_FILE, encoding="utf-8", sep="\t")
+df_output = df_output.sort_values("question_no", key=lambda col: col.map(question_order))
+df_output.to_csv(OUTPUT_FILE, sep="\t", encoding="utf-8", index=False)
 
-df.to_csv(f"output_{TRAIN_TEST}_{MODEL}.csv", sep="\t", encoding="utf-8", index=False)
+# Unanswered questions would score 0 in the evaluation, so fail the run (and stop run_all_models.sh) rather than let a
+# brief outage lower the scores. The failures are not cached, so running the script again only asks those questions.
+if num_failed > 0:
+    sys.exit(1)
@@ -4,21 +4,61 @@ Run all train or test questions through Insolvency Bot
 Usage: python generate_responses_insolvency_bot.py gpt-3.5-turbo|gpt-4 train|test
 
 You need to set environment variable OPENAI_API_KEY first.
+
+Responses are cached in .llm_cache, so a re-run only asks questions which have changed, or all of them if the bot's
+Python source in ../insolvency/ has changed. Delete that folder to ask them all again.
 '''
 
+import hashlib
 import os
 import re
 import sys
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import requests
+import response_cache
+import retry_backoff
 sys.path.append("../insolvency/")
+import insolvency_bot
 from insolvency_bot import answer_question
 
 SUPPORTED_MODELS = {'gpt-3.5-turbo', 'gpt-4', 'gpt-4o'}
 SUPPORTED_MODELS_CONCAT = '|'.join(SUPPORTED_MODELS)
 COMMAND_LINE_PARAM = f"Usage: python generate_responses_insolvency_bot.py {SUPPORTED_MODELS_CONCAT} train|test"
+# Number of questions sent to the bot concurrently. Kept at 1 because answer_question is not known to be thread-safe,
+# and because concurrent calls would inflate bot_response_time compared with earlier runs and the GPT baselines.
+MAX_WORKERS = 1
+# Folders next to the bot which hold installed packages rather than the bot's own code, and so are left out of its hash.
+EXCLUDED_SOURCE_DIRS = {"__pycache__", "venv", "env", "site-packages", "node_modules", "build", "dist"}
+
+re_whitespace = re.compile(r'\s+')
+
+
+def get_bot_source_hash():
+    '''
+    Return a hash of the Insolvency Bot's Python source, so that cached answers are not reused once the bot changes.
+
+    Virtualenvs (any folder containing pyvenv.cfg) and the folders in EXCLUDED_SOURCE_DIRS are skipped.
+    '''
+    sha = hashlib.sha256()
+    bot_dir = os.path.dirname(os.path.abspath(insolvency_bot.__file__))
+    for root, dirs, files in os.walk(bot_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d not in EXCLUDED_SOURCE_DIRS
+                         and not os.path.exists(os.path.join(root, d, "pyvenv.cfg")))
+        for file in sorted(files):
+            if file.endswith(".py"):
+                path = os.path.join(root, file)
+                sha.update(os.path.relpath(path, bot_dir).encode("utf-8"))
+                with open(path, "rb") as f:
+                    sha.update(f.read())
+    return sha.hexdigest()[:12]
+
+
+# Written to the output when every attempt fails. The script then exits with an error, see the end of the file.
+EMPTY_RESULT = {"response": "", "time": None, "attempts": retry_backoff.MAX_ATTEMPTS, "statutes": "", "cases": "", "forms": ""}
 
 if len(sys.argv) != 3:
     print(COMMAND_LINE_PARAM)
@@ -37,6 +77,9 @@ TRAIN_TEST = sys.argv[2]
 
 print(f"Dataset: {TRAIN_TEST}")
 
+BOT_SOURCE_HASH = get_bot_source_hash()
+print(f"Insolvency Bot source hash: {BOT_SOURCE_HASH}")
+
 df = pd.read_csv(f"{TRAIN_TEST}_questions.csv", encoding="utf-8", sep="\t")
 
 headers = {
@@ -44,21 +87,26 @@ headers = {
     'Authorization': 'Bearer ' + os.environ["OPENAI_API_KEY"],
 }
 
-bot_responses = [""] * len(df)
-bot_times = [0] * len(df)
-bot_attempts = [0] * len(df)
-bot_statutes = [""] * len(df)
-bot_cases = [""] * len(df)
-bot_forms = [""] * len(df)
-for idx in range(len(df)):
-    q = df.question_text.iloc[idx]
-    q_no = df.question_no.iloc[idx]
-    print(f"Asking question: {q_no}: {q}")
+OUTPUT_FILE = f"output_{TRAIN_TEST}_insolvency_bot_with_{MODEL}.csv"
+OUTPUT_COLUMNS = list(df.columns) + ["bot_response", "bot_response_time", "bot_response_attempts", "bot_statutes",
+                                     "bot_cases", "bot_forms"]
+
+# Each row is appended to the output file as soon as it is answered, so a crash part way through keeps what was done.
+output_lock = threading.Lock()
+pd.DataFrame(columns=OUTPUT_COLUMNS).to_csv(OUTPUT_FILE, sep="\t", encoding="utf-8", index=False)
 
-    starttime = time.time()
 
-    for attempt in range(3):
-        print("attempt calling GPT API:", attempt)
+def write_row(row):
+    with output_lock:
+        pd.DataFrame([row], columns=OUTPUT_COLUMNS).to_csv(OUTPUT_FILE, mode="a", header=False, sep="\t",
+                                                          encoding="utf-8", index=False)
+
+
+def ask_insolvency_bot(q, q_no):
+    starttime = time.perf_counter()
+
+    for attempt in range(retry_backoff.MAX_ATTEMPTS):
+        print(f"{q_no}: attempt calling GPT API:", attempt)
         try:
             insolvency_bot_response_json = answer_question(q, False, MODEL)
             r = insolvency_bot_response_json["_response"]
@@ -66,27 +114,67 @@ for idx in range(len(df)):
             cases = "|".join(insolvency_bot_response_json["cases"])
             forms = "|".join(insolvency_bot_response_json["forms"])
             break
-        except:
-            print("Try again")
+        except Exception as e:
             traceback.print_exc()
-            time.sleep(10)
+            if not retry_backoff.is_retryable(error=e):
+                print(f"{q_no}: Not retrying after {type(e).__name__}")
+                return None
+            if attempt < retry_backoff.MAX_ATTEMPTS - 1:
+                print(f"{q_no}: Try again")
+                time.sleep(retry_backoff.get_delay(attempt, error=e))
+    else:
+        # Return nothing, so that the failure is not cached and the question is asked again on the next run.
+        return None
 
-    bot_responses[idx] = re.sub(r'\s+', ' ', r)
+    endtime = time.perf_counter()
 
-    endtime = time.time()
-    bot_times[idx] = endtime - starttime
-    bot_attempts[idx] = attempt + 1
-    bot_statutes[idx] = statutes
-    bot_cases[idx] = cases
-    bot_forms[idx] = forms
+    return {"response": r, "time": endtime - starttime, "attempts": attempt + 1,
+            "statutes": statutes, "cases": cases, "forms": forms}
 
-    print("\tReceived response: ", r)
 
-df["bot_response"] = bot_responses
-df["bot_response_time"] = bot_times
-df["bot_response_attempts"] = bot_attempts
-df["bot_statutes"] = bot_statutes
-df["bot_cases"] = bot_cases
-df["bot_forms"] = bot_forms
+def process_question(question):
+    q = question.question_text
+    q_no = question.question_no
+    print(f"Asking question: {q_no}: {q}")
 
-df.to_csv(f"output_{TRAIN_TEST}_insolvency_bot_with_{MODEL}.csv", sep="\t", encoding="utf-8", index=False)
+    # Namespace the cache key so that these don't collide with plain GPT responses to the same question, and so that
+    # answers from an older version of the bot are not reused.
+    result = response_cache.get_or_compute(f"insolvency_bot_{BOT_SOURCE_HASH}_with_{MODEL}", q,
+                                           lambda: ask_insolvency_bot(q, q_no))
+    answered = result is not None
+    if not answered:
+        print(f"\tNo response to {q_no}")
+        result = EMPTY_RESULT
+    r = result["response"]
+
+    row = question._asdict()
+    row["bot_response"] = re_whitespace.sub(' ', r)
+    row["bot_response_time"] = result["time"]
+    row["bot_response_attempts"] = result["attempts"]
+    row["bot_statutes"] = result["statutes"]
+    row["bot_cases"] = result["cases"]
+    row["bot_forms"] = result["forms"]
+    write_row(row)
+
+    print(f"\tReceived response to {q_no}: ", r)
+
+    return answered
+
+
+# The questions are independent, so they can be sent several at once if MAX_WORKERS is raised.
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    answered = list(executor.map(process_question, df.itertuples(index=False)))
+
+print(f"Response cache: {response_cache.hits} hits, {response_cache.misses} misses")
+num_failed = answered.count(False)
+print(f"Questions with no response: {num_failed}")
+
+# Rows were appended in the order they finished, so put them back in question order.
+question_order = {q_no: i for i, q_no in enumerate(df.question_no)}
+df_output = pd.read_csv(OUTPUT_FILE, encoding="utf-8", sep="\t")
+df_output = df_output.sort_values("question_no", key=lambda col: col.map(question_order))
+df_output.to_csv(OUTPUT_FILE, sep="\t", encoding="utf-8", index=False)
+
+# As in generate_responses_gpt.py, an unanswered question would score 0, so fail the run rather than lower the scores.
+if num_failed > 0:
+    sys.exit(1)
@@ -0,0 +1,77 @@
+'''
+Persistent on-disk cache of LLM responses, keyed by model and question text.
+
+Used by the generate_responses_*.py scripts so that a re-run only calls the API for questions whose text or model
+has changed. Delete the .llm_cache folder to force every question to be asked again.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_FILE = os.path.join(".llm_cache", "responses.sqlite")
+
+_lock = threading.Lock()
+_connection = None
+hits = 0
+misses = 0
+
+
+def _get_connection():
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        _connection = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+        _connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT)")
+    return _connection
+
+
+def _get_key(model, question):
+    return hashlib.sha256(f"{model}\0{question}".encode("utf-8")).hexdigest()
+
+
+def get(model, question):
+    '''
+    Return the cached result for this model and question, or None if there is none.
+    '''
+    with _lock:
+        row = _get_connection().execute("SELECT value FROM responses WHERE key = ?", (_get_key(model, question),)).fetchone()
+    return None if row is None else json.loads(row[0])
+
+
+def put(model, question, value):
+    '''
+    Cache value, which must be a JSON-serialisable dict, as the result for this model and question.
+    '''
+    value["timestamp"] = time.time()
+    with _lock:
+        connection = _get_connection()
+        connection.execute("INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)",
+                           (_get_key(model, question), json.dumps(value)))
+        connection.commit()
+
+
+def get_or_compute(model, question, fn):
+    '''
+    Return the cached result for this model and question, or call fn() and cache what it returns.
+
+    fn must return a JSON-serialisable dict, or None if it failed. Failures, and exceptions raised by fn, are not cached.
+    '''
+    global hits, misses
+    value = get(model, question)
+    if value is not None:
+        with _lock:
+            hits += 1
+        return value
+
+    value = fn()
+
+    with _lock:
+        misses += 1
+    if value is not None:
+        put(model, question, value)
+
+    return value
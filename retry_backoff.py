@@ -0,0 +1,62 @@
+'''
+Number of attempts at an LLM API call, and the delay between them.
+
+Uses exponential backoff with jitter, so that workers which fail together do not all retry at the same moment.
+If the API sent a Retry-After header (e.g. when rate limiting), that is honoured instead.
+
+Client errors other than rate limiting and timeouts are not retried, as they would fail the same way every time.
+'''
+
+import random
+
+MAX_ATTEMPTS = 5
+# The delay after attempt n is drawn from the upper half of BACKOFF_BASE_SECONDS * 2 ** n, i.e. 2.5-5s, 5-10s, 10-20s
+# and 20-40s between the five attempts, which is never less than the fixed 10s per failure that was used before.
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 60  # Also caps how long a Retry-After header can make us wait.
+RETRYABLE_CLIENT_ERRORS = {408, 409, 429}
+
+
+def _get_response(response, error):
+    '''
+    Return the HTTP response of a failed attempt, from either the response itself or the exception raised by the API
+    client (the openai package attaches it to its errors), or None if there was no response.
+    '''
+    if response is not None:
+        return response
+    if error is not None and getattr(error, "response", None) is not None:
+        return error.response
+    if error is not None and getattr(error, "headers", None) is not None:
+        return error
+    return None
+
+
+def get_delay(attempt, response=None, error=None):
+    '''
+    Return how many seconds to wait after the given (zero-based) attempt failed.
+
+    response is the HTTP response of the failed attempt, if one was received, and error the exception it raised.
+    '''
+    response = _get_response(response, error)
+    if response is not None:
+        try:
+            return min(BACKOFF_MAX_SECONDS, float(response.headers["Retry-After"]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def is_retryable(response=None, error=None):
+    '''
+    Return whether it is worth trying again after an attempt failed.
+
+    A bad request, API key or model name (400, 401, 403, 404 etc.) is not retried. Rate limiting, timeouts, server
+    errors and failures without any HTTP response, such as a dropped connection, are.
+    '''
+    status_code = getattr(_get_response(response, error), "status_code", None)
+    if status_code is None and error is not None:
+        status_code = getattr(error, "http_status", None)
+    if not isinstance(status_code, int):
+        return True
+    return not 400 <= status_code < 500 or status_code in RETRYABLE_CLIENT_ERRORS